@@ -1,106 +1,376 @@
 import os
 import re
-import requests
+import hashlib
+import random
+import shelve
+import asyncio
+import aiohttp
+import aiofiles
+import aiofiles.os
 from dotenv import load_dotenv
 import time
-from colorama import init, Fore, Style
+from collections import Counter
+from dataclasses import dataclass, field
+import logging
+import sys
 import json
+from email.utils import parsedate_to_datetime
 
-# Initialize colorama for cross-platform colored output
-init()
+# orjson parses the many small NDJSON chunks from Ollama noticeably faster, when installed
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+try:
+    from datasketch import MinHash, MinHashLSH
+except ImportError:
+    MinHashLSH = None
 
 # Load environment variables
 load_dotenv()
 
+# Log to stderr, with colors from rich when it is installed
+try:
+    from rich.logging import RichHandler
+    log_handler = RichHandler(show_path=False)
+except ImportError:
+    # Without colors, show the level so errors and warnings stand out
+    log_handler = logging.StreamHandler(sys.stderr)
+    log_handler.setFormatter(logging.Formatter('%(levelname)s: %(message)s'))
+logging.basicConfig(level=os.getenv('LOG_LEVEL', 'INFO').upper(), format='%(message)s', handlers=[log_handler])
+logger = logging.getLogger('obsidian_autotag')
+
 # Get API key and Obsidian directory from environment variables
 claude_api_key = os.getenv('CLAUDE_API_KEY')
 obsidian_directory = os.getenv('OBSIDIAN_DIRECTORY')
 use_ollama = os.getenv('USE_OLLAMA', 'false').lower() == 'true'
 ollama_model = os.getenv('OLLAMA_MODEL', 'llama2')
+claude_model = 'claude-3-opus-20240229'
+
+# Identifies the backend and model that generated cached tags, so switching models doesn't reuse another model's tags
+tag_model = f"ollama:{ollama_model}" if use_ollama else f"claude:{claude_model}"
+
+# Cap the number of in-flight LLM requests; the semaphore is created in main() so it belongs to the running loop
+concurrency = int(os.getenv('CONCURRENCY', '12'))
+sem = None
+
+# Group Claude requests into multi-document batches (BATCH_SIZE=1 disables batching)
+batch_size = int(os.getenv('BATCH_SIZE', '8'))
+batch_max_chars = int(os.getenv('BATCH_MAX_CHARS', '50000'))
+
+# Model temperature for each attempt; retries after too many tags get more deterministic
+retry_temperatures = (0.7, 0.3, 0.0)
+
+# Retry failed connections and 429/5xx responses with exponential backoff and full jitter
+http_max_tries = 3
+http_backoff_base = 1.0
+
+# Longer notes are cut down to their start and end before being sent to the model
+max_content_chars = int(os.getenv('MAX_CONTENT_CHARS', '8000'))
+truncation_marker = "\n...[truncated]...\n"
+
+# Persistent cache of generated tags, keyed by a hash of the note content
+cache_dir = os.path.expanduser(os.getenv('CACHE_DIR', '~/.cache/obsidian-autotag'))
+tag_cache = {}
 
-# Global variables for statistics
-start_time = time.time()
-api_queries = 0
-total_tokens = 0
+# Notes at least this similar (estimated Jaccard over 5-grams) share cached tags; needs datasketch
+near_duplicate_threshold = float(os.getenv('NEAR_DUPLICATE_THRESHOLD', '0.9'))
+near_duplicate_index = None
+minhash_permutations = 128
 
-def scan_directory(directory):
+# Size and mtime of each file when it was last tagged, so unchanged files can be skipped without reading them
+file_index_path = os.path.join(cache_dir, 'index.json')
+file_index = {}
+
+# Matches the "Tags:" line of a note
+TAGS_RE = re.compile(r'\nTags:[ \t]*(.*?)$', re.MULTILINE)
+# Matches a single '#tag' on that line, capturing the tag name
+TAG_TOKEN_RE = re.compile(r'#([^\s#]+)')
+
+# Directories skipped while scanning (in addition to hidden ones)
+excluded_dirs = ('zTemplates', 'cheat-sheets-main', 'zz_Attachments', '00 Monthly Tasks', 'BMO', 'zz_Archive')
+
+@dataclass
+class Stats:
     """
-    Recursively scan the given directory for markdown files and process them.
+    Run statistics shared by the tagging tasks.
+    Updates happen on the event loop thread only, so they need no lock.
     """
-    print(f"{Fore.CYAN}Scanning directory: {directory}{Style.RESET_ALL}")
-    processed_files = []
-    for root, dirs, files in os.walk(directory):
-        dirs[:] = [d for d in dirs if not d.startswith('.') and d not in ('zTemplates', 'cheat-sheets-main', 'zz_Attachments', '00 Monthly Tasks', 'BMO', 'zz_Archive')]
-        for file in files:
-            if file.endswith('.md'):
-                file_path = os.path.join(root, file)
-                result = process_file(file_path)
-                processed_files.append(result)
-    
-    print_statistics(processed_files)
+    start_time: float = field(default_factory=time.time)
+    api_queries: int = 0
+    total_tokens: int = 0
+    # Number of processed files per result status
+    file_counts: Counter = field(default_factory=Counter)
 
-def process_file(file_path, retry_limit=3):
+async def awalk(root, queue):
+    """
+    Recursively walk the given directory, putting markdown file paths on the queue as they are found.
+    """
+    try:
+        with await aiofiles.os.scandir(root) as it:
+            entries = await asyncio.get_running_loop().run_in_executor(None, list, it)
+    except OSError:
+        return
+
+    subdirs = []
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            if not entry.name.startswith('.') and entry.name not in excluded_dirs:
+                subdirs.append(asyncio.create_task(awalk(entry.path, queue)))
+        elif entry.name.endswith('.md'):
+            await queue.put(entry.path)
+    await asyncio.gather(*subdirs)
+
+async def scan_directory(session, stats, directory):
+    """
+    Recursively scan the given directory for markdown files and process them concurrently.
+    Files are processed as soon as they are discovered rather than after the full walk.
+    """
+    logger.info("Scanning directory: %s", directory)
+    queue = asyncio.Queue()
+
+    async def worker():
+        while True:
+            file_path = await queue.get()
+            if file_path is None:
+                break
+            result = await process_file(session, stats, file_path)
+            stats.file_counts[result['status']] += 1
+
+    # Batched requests hold several files each, so keep enough workers to fill every batch
+    worker_count = concurrency if use_ollama else concurrency * max(batch_size, 1)
+    workers = [asyncio.create_task(worker()) for _ in range(worker_count)]
+    await awalk(directory, queue)
+    for _ in workers:
+        await queue.put(None)
+    await asyncio.gather(*workers)
+
+    print_statistics(stats)
+
+async def process_file(session, stats, file_path, retry_limit=3):
+    """
+    Process a single markdown file, skipping it if it hasn't changed since it was last tagged.
     """
-    Process a single markdown file. Check if it has tags, and if not, generate and add them.
+    index_key = os.path.abspath(file_path)
+    st = await aiofiles.os.stat(file_path)
+    indexed = file_index.get(index_key)
+    if indexed and indexed['mtime_ns'] == st.st_mtime_ns and indexed['size'] == st.st_size:
+        logger.info("Skipping unchanged file: %s", file_path)
+        return {"file": file_path, "status": "existing_tags", "tags": indexed['tags']}
+
+    result = await tag_file(session, stats, file_path, retry_limit)
+    if result['status'] != 'failed':
+        # Stat again, since adding tags changes the file
+        st = await aiofiles.os.stat(file_path)
+        file_index[index_key] = {"mtime_ns": st.st_mtime_ns, "size": st.st_size, "tags": result['tags']}
+    return result
+
+async def tag_file(session, stats, file_path, retry_limit=3):
+    """
+    Check if a markdown file has tags, and if not, generate and add them.
     If the generated tags exceed 10, retry up to `retry_limit` times.
     """
-    print(f"\n{Fore.BLUE}Processing file: {file_path}{Style.RESET_ALL}")
-    with open(file_path, 'r', encoding='utf-8') as file:
-        content = file.read()
+    logger.info("Processing file: %s", file_path)
+    # Keep the raw bytes so the Tags line can be rewritten in place; parse with normalised newlines
+    async with aiofiles.open(file_path, 'rb') as file:
+        raw = await file.read()
+    content = raw.decode('utf-8').replace('\r\n', '\n').replace('\r', '\n')
 
+    tags_match = find_tags_line(content)
     existing_tags = extract_existing_tags(content)
     if len(existing_tags) < 9:
-        print(f"{Fore.YELLOW}Less than 9 existing tags found. Generating additional tags...{Style.RESET_ALL}")
+        logger.info("Less than 9 existing tags found in %s. Generating additional tags...", file_path)
         retry_count = 0
         while retry_count < retry_limit:
-            suggested_tags = get_suggested_tags(content)
+            suggested_tags = await get_suggested_tags(session, stats, file_path, content, attempt=retry_count)
             if suggested_tags:
                 if len(suggested_tags) > 10:
-                    print(f"{Fore.YELLOW}Warning: Generated more than 10 tags. Retrying...{Style.RESET_ALL}")
+                    logger.warning("Generated more than 10 tags for %s. Retrying...", file_path)
                     retry_count += 1
                 else:
-                    # Combine existing and suggested tags
-                    all_tags = existing_tags + [tag for tag in suggested_tags if tag not in existing_tags]
-                    # Correct tags to ensure they have '#' symbol
+                    # Combine existing and suggested tags, ensuring each has one '#' symbol and appears once
+                    seen = set()
                     corrected_tags = []
-                    for tag in all_tags:
-                        if not tag.startswith('#'):
-                            tag = '#' + tag.strip()
-                        corrected_tags.append(tag)
+                    for tag in existing_tags + suggested_tags:
+                        name = tag.lstrip('#').strip()
+                        if name and name not in seen:
+                            seen.add(name)
+                            corrected_tags.append('#' + name)
                     # Truncate to 10 tags if necessary
                     corrected_tags = corrected_tags[:10]
-                    tag_string = ' '.join(corrected_tags)
-                    if re.search(r'\nTags:\s*(.*?)$', content, re.MULTILINE):
-                        content = re.sub(r'\nTags:\s*(.*?)$', f"\nTags: {tag_string}", content, flags=re.MULTILINE)
-                    else:
-                        content += f"\nTags: {tag_string}"
-                    with open(file_path, 'w', encoding='utf-8') as file:
-                        file.write(content)
-                    print(f"{Fore.GREEN}Updated tags: {tag_string}{Style.RESET_ALL}")
+                    # Keep the existing Tags line as written (including any words that aren't '#tags') and append the new tags
+                    existing_text = tags_match.group(1).strip() if tags_match else ''
+                    new_tags = [tag for tag in corrected_tags if tag[1:] not in existing_tags]
+                    tag_string = ' '.join(([existing_text] if existing_text else []) + new_tags)
+                    await write_tags(file_path, raw, tag_string)
+                    logger.info("Updated tags for %s: %s", file_path, tag_string)
                     return {"file": file_path, "status": "tags_updated", "tags": corrected_tags}
             else:
-                print(f"{Fore.RED}Failed to generate tags.{Style.RESET_ALL}")
+                logger.error("Failed to generate tags for %s.", file_path)
                 return {"file": file_path, "status": "failed", "tags": []}
-        print(f"{Fore.RED}Exceeded retry limit. Skipping file.{Style.RESET_ALL}")
+        logger.error("Exceeded retry limit for %s. Skipping file.", file_path)
         return {"file": file_path, "status": "failed", "tags": []}
     else:
-        print(f"{Fore.CYAN}10 or more existing tags found: {' '.join(existing_tags)}{Style.RESET_ALL}")
+        logger.info("10 or more existing tags found in %s: %s", file_path, ' '.join(existing_tags))
         return {"file": file_path, "status": "existing_tags", "tags": existing_tags}
 
-def get_suggested_tags(content):
+async def write_tags(file_path, raw, tag_string):
+    """
+    Write the Tags line to the file, keeping its line endings. Only the Tags line and
+    what follows it are written instead of the whole note.
+    """
+    newline = b'\r\n' if b'\r\n' in raw else b'\n'
+    tags_line = newline + f"Tags: {tag_string}".encode('utf-8')
+    tags_start = raw.rfind(b'\nTags:')
+    if tags_start == -1:
+        async with aiofiles.open(file_path, 'ab') as file:
+            await file.write(tags_line)
+    else:
+        # Replace the Tags line, keeping its line break and everything after it as raw bytes
+        line_end = raw.find(b'\n', tags_start + 1)
+        if line_end == -1:
+            line_end = len(raw)
+        if raw[line_end - 1:line_end] == b'\r':
+            line_end -= 1
+        if raw[tags_start - 1:tags_start] == b'\r':
+            tags_start -= 1
+        async with aiofiles.open(file_path, 'r+b') as file:
+            await file.seek(tags_start)
+            await file.write(tags_line + raw[line_end:])
+            await file.truncate()
+
+async def get_suggested_tags(session, stats, file_path, content, attempt=0):
     """
     Get suggested tags using either Ollama or Claude API.
+    Tags are cached by content hash, so unchanged (or near-duplicate) notes don't query the model again.
+    Each retry `attempt` uses a lower temperature, and retries are sent on their own rather than batched.
     """
+    key = hashlib.blake2b(f"{tag_model}\n{content}".encode(), digest_size=16).hexdigest()
+    if key in tag_cache:
+        logger.info("Using cached tags for %s.", file_path)
+        return tag_cache[key]
+
+    minhash = None
+    if near_duplicate_index is not None:
+        minhash = content_minhash(content)
+        for neighbour in near_duplicate_index.query(minhash):
+            if neighbour in tag_cache:
+                logger.info("Using cached tags for %s from a near-duplicate note.", file_path)
+                return tag_cache[neighbour]
+
+    # Frontmatter and conclusions are usually enough to tag a note, so skip the middle of long ones
+    if len(content) > max_content_chars + len(truncation_marker):
+        half = max_content_chars // 2
+        content = content[:half] + truncation_marker + content[len(content) - half:]
+
+    temperature = retry_temperatures[min(attempt, len(retry_temperatures) - 1)]
     if use_ollama:
-        return get_suggested_tags_ollama(content)
+        async with sem:
+            tags = await get_suggested_tags_ollama(session, stats, file_path, content, temperature)
+    elif batch_size > 1 and attempt == 0:
+        tags = await claude_batcher.submit(session, stats, file_path, content)
     else:
-        return get_suggested_tags_claude(content)
+        async with sem:
+            tags = await get_suggested_tags_claude(session, stats, file_path, content, temperature)
+
+    # Only cache usable results so retries still reach the model
+    if tags and len(tags) <= 10:
+        tag_cache[key] = tags
+        if minhash is not None and key not in near_duplicate_index:
+            tag_cache['minhash:' + key] = (tag_model, minhash)
+            near_duplicate_index.insert(key, minhash)
+    return tags
+
+def content_minhash(content):
+    """
+    Build a MinHash signature of the content's character 5-grams.
+    """
+    text = ' '.join(content.lower().split())
+    minhash = MinHash(num_perm=minhash_permutations)
+    minhash.update_batch([text[i:i + 5].encode() for i in range(max(len(text) - 4, 1))])
+    return minhash
 
-def get_suggested_tags_ollama(content):
+def open_tag_cache():
+    """
+    Open the persistent tag cache and, if datasketch is installed, rebuild the near-duplicate index from it.
+    """
+    global tag_cache, near_duplicate_index
+    os.makedirs(cache_dir, exist_ok=True)
+    tag_cache = shelve.open(os.path.join(cache_dir, 'tags.db'))
+    if MinHashLSH is not None:
+        near_duplicate_index = MinHashLSH(threshold=near_duplicate_threshold, num_perm=minhash_permutations)
+        for cache_key in tag_cache.keys():
+            if cache_key.startswith('minhash:'):
+                model, minhash = tag_cache[cache_key]
+                if model == tag_model:
+                    near_duplicate_index.insert(cache_key[len('minhash:'):], minhash)
+
+def load_file_index():
+    """
+    Load the index of previously tagged files, if there is one.
+    """
+    global file_index
+    try:
+        with open(file_index_path, 'r', encoding='utf-8') as file:
+            file_index = json.load(file)
+    except (OSError, json.JSONDecodeError):
+        file_index = {}
+
+def save_file_index():
+    """
+    Save the index of tagged files, replacing the previous one atomically.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    temp_path = file_index_path + '.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as file:
+        json.dump(file_index, file)
+    os.replace(temp_path, file_index_path)
+
+async def post_with_backoff(session, url, **kwargs):
+    """
+    POST to the URL through the shared session, retrying connection errors and 429/5xx responses
+    with exponential backoff and full jitter, waiting at least as long as a 429's Retry-After header.
+    Returns the last response, which the caller must release.
+    """
+    for attempt in range(http_max_tries):
+        delay = random.uniform(0, http_backoff_base * 2 ** attempt)
+        try:
+            response = await session.post(url, **kwargs)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            if attempt == http_max_tries - 1:
+                raise
+            logger.warning("Request to %s failed: %s. Retrying...", url, e)
+        else:
+            if (response.status != 429 and response.status < 500) or attempt == http_max_tries - 1:
+                return response
+            if response.status == 429:
+                # A rate-limited server says how long to wait; never retry sooner than that
+                delay = max(delay, retry_after_seconds(response.headers.get('Retry-After')))
+            logger.warning("Request to %s returned %s. Retrying...", url, response.status)
+            response.release()
+        await asyncio.sleep(delay)
+
+def retry_after_seconds(value):
+    """
+    Parse a Retry-After header, given as seconds or an HTTP date, into seconds. Returns 0 if missing or invalid.
+    """
+    if not value:
+        return 0
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        return 0
+
+async def get_suggested_tags_ollama(session, stats, file_path, content, temperature=retry_temperatures[0]):
     """
     Send the content to Ollama and get suggested tags.
     """
-    global api_queries, total_tokens
     prompt = f"""
 You are an AI assistant tasked with generating exactly 9 relevant tags for an Obsidian markdown file. Your goal is to analyze the provided content and suggest 9 distinct tags that comprehensively classify the key topics discussed in the text.
 
@@ -135,43 +405,60 @@ Provide your response with only the 9 tags, following the format specified above
 """
 
 
-    print(f"{Fore.YELLOW}Sending request to Ollama...{Style.RESET_ALL}")
-    api_queries += 1
-    response = requests.post('http://localhost:11434/api/generate',
-                             json={
-                                 "model": ollama_model,
-                                 "prompt": prompt,
-                             })
-
-    if response.status_code == 200:
-        try:
-            response_lines = response.text.strip().split('\n')
-            response_json = json.loads(response_lines[-1])
-            response_text = ''.join(json.loads(line)['response'] for line in response_lines)
-            tags = response_text.strip().split()
-            corrected_tags = []
-            for tag in tags:
-                tag = tag.strip('# ')
-                if not tag.startswith('#'):
-                    tag = '#' + tag
-                corrected_tags.append(tag)
-            total_tokens += response_json.get('total_tokens', 0)
-            print(f"{Fore.GREEN}Received tags from Ollama.{Style.RESET_ALL}")
-            return corrected_tags
-        except (json.JSONDecodeError, KeyError) as e:
-            print(f"{Fore.RED}Error decoding JSON response from Ollama: {e}{Style.RESET_ALL}")
-            print(f"{Fore.RED}Response content: {response.text}{Style.RESET_ALL}")
-            return None
-    else:
-        print(f"{Fore.RED}Error with Ollama: {response.status_code}, {response.text}{Style.RESET_ALL}")
+    logger.info("Sending request to Ollama for %s...", file_path)
+    stats.api_queries += 1
+    try:
+        async with await post_with_backoff(session, 'http://localhost:11434/api/generate',
+                                           json={
+                                               "model": ollama_model,
+                                               "prompt": prompt,
+                                               "options": {"temperature": temperature},
+                                           },
+                                           # The final line carries the whole token context, which can exceed aiohttp's default line limit
+                                           read_bufsize=2 ** 22) as response:
+            if response.status != 200:
+                response_body = await response.text()
+                logger.error("Error with Ollama for %s: %s, %s", file_path, response.status, response_body)
+                return None
+
+            # Ollama streams one JSON object per line; parse each line once as it arrives
+            text_parts = []
+            try:
+                async for line in response.content:
+                    if not line.strip():
+                        continue
+                    try:
+                        response_json = json_loads(line)
+                        text_parts.append(response_json['response'])
+                    except (json.JSONDecodeError, KeyError) as e:
+                        logger.error("Error decoding JSON response from Ollama for %s: %s", file_path, e)
+                        logger.error("Response content: %r", line)
+                        return None
+                    if response_json.get('done'):
+                        stats.total_tokens += response_json.get('prompt_eval_count', 0) + response_json.get('eval_count', 0)
+            except (ValueError, aiohttp.http_exceptions.LineTooLong) as e:
+                # Raised by aiohttp (depending on version) for a line longer than read_bufsize
+                logger.error("Error reading response from Ollama for %s: %s", file_path, e)
+                return None
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logger.error("Error with Ollama for %s: %r", file_path, e)
         return None
 
+    tags = ''.join(text_parts).strip().split()
+    corrected_tags = []
+    for tag in tags:
+        tag = tag.strip('# ')
+        if not tag.startswith('#'):
+            tag = '#' + tag
+        corrected_tags.append(tag)
+    logger.info("Received tags from Ollama for %s.", file_path)
+    return corrected_tags
 
-def get_suggested_tags_claude(content):
+
+async def get_suggested_tags_claude(session, stats, file_path, content, temperature=retry_temperatures[0]):
     """
     Send the content to Claude API and get suggested tags.
     """
-    global api_queries, total_tokens
     system_prompt = """
     
 You are an AI assistant tasked with generating exactly 9 relevant tags for an Obsidian markdown file. Your goal is to analyze the provided content and suggest 9 distinct tags that comprehensively classify the key topics discussed in the text.
@@ -206,84 +493,253 @@ Your output should look like this:
 Provide your response with only the 9 tags, following the format specified above.
     """
 
-    print(f"{Fore.YELLOW}Sending request to Claude API...{Style.RESET_ALL}")
-    api_queries += 1
-    response = requests.post(
-        "https://api.anthropic.com/v1/messages",
-        headers={
-            "Content-Type": "application/json",
-            "X-API-Key": claude_api_key,
-        },
-        json={
-            "model": "claude-3-opus-20240229",
-            "max_tokens": 1000,
-            "messages": [
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": content}
-            ]
-        }
-    )
-
-    if response.status_code == 200:
-        response_json = response.json()
-        tags = response_json['content'][0]['text'].strip().split()
-        total_tokens += response_json.get('usage', {}).get('total_tokens', 0)
-        print(f"{Fore.GREEN}Received tags from Claude API.{Style.RESET_ALL}")
+    logger.info("Sending request to Claude API for %s...", file_path)
+    stats.api_queries += 1
+    try:
+        async with await post_with_backoff(
+            session,
+            "https://api.anthropic.com/v1/messages",
+            headers={
+                "Content-Type": "application/json",
+                "X-API-Key": claude_api_key,
+                "anthropic-version": "2023-06-01",
+            },
+            json={
+                "model": claude_model,
+                "max_tokens": 1000,
+                "temperature": temperature,
+                "system": system_prompt,
+                "messages": [
+                    {"role": "user", "content": content}
+                ]
+            }
+        ) as response:
+            response_body = await response.text()
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logger.error("Error with Claude API for %s: %r", file_path, e)
+        return None
+
+    if response.status == 200:
+        try:
+            response_json = json_loads(response_body)
+            tags = response_json['content'][0]['text'].strip().split()
+            usage = response_json.get('usage', {})
+            stats.total_tokens += usage.get('input_tokens', 0) + usage.get('output_tokens', 0)
+        except (json.JSONDecodeError, KeyError, IndexError, TypeError, AttributeError) as e:
+            logger.error("Error decoding response from Claude API for %s: %s", file_path, e)
+            return None
+        logger.info("Received tags from Claude API for %s.", file_path)
         return tags
     else:
-        print(f"{Fore.RED}Error with Claude API: {response.status_code}, {response.text}{Style.RESET_ALL}")
+        logger.error("Error with Claude API for %s: %s, %s", file_path, response.status, response_body)
         return None
 
+async def get_suggested_tags_claude_batch(session, stats, items):
+    """
+    Send several documents to Claude API in one request and get suggested tags for each.
+    `items` is a list of (doc_id, content) tuples; returns a dict mapping doc_id to its tags.
+    """
+    system_prompt = """
+You are an AI assistant tasked with generating exactly 9 relevant tags for each of several Obsidian markdown files. Each file is provided in its own <doc id="..."> block.
+
+For every document:
+1. Carefully read and analyze the content of the document.
+2. Identify the main topics, themes, and key concepts present in the text.
+3. Generate exactly 9 distinct tags that best represent that document.
+4. Each tag should be a single word or a short phrase, prefixed with the '#' symbol.
+5. Do not include tags related to the Obsidian software (e.g #Obsidian or #Content or #Markdown) Focus on the content.
+
+Respond with a single JSON object and nothing else. Each key is a document id and each value is the list of 9 tags for that document, for example:
+{"1": ["#tag1", "#tag2", "#tag3", "#tag4", "#tag5", "#tag6", "#tag7", "#tag8", "#tag9"]}
+    """
+    documents = '\n'.join(f'<doc id="{doc_id}">\n{content}\n</doc>' for doc_id, content in items)
+
+    logger.info("Sending batch of %d files to Claude API...", len(items))
+    stats.api_queries += 1
+    try:
+        async with await post_with_backoff(
+            session,
+            "https://api.anthropic.com/v1/messages",
+            headers={
+                "Content-Type": "application/json",
+                "X-API-Key": claude_api_key,
+                "anthropic-version": "2023-06-01",
+            },
+            json={
+                "model": claude_model,
+                "max_tokens": 200 * len(items),
+                "temperature": retry_temperatures[0],
+                "system": system_prompt,
+                "messages": [
+                    {"role": "user", "content": documents}
+                ]
+            }
+        ) as response:
+            response_body = await response.text()
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logger.error("Error with Claude API: %r", e)
+        return None
+
+    if response.status == 200:
+        try:
+            response_json = json_loads(response_body)
+            results = json_loads(response_json['content'][0]['text'])
+            usage = response_json.get('usage', {})
+            stats.total_tokens += usage.get('input_tokens', 0) + usage.get('output_tokens', 0)
+        except (json.JSONDecodeError, KeyError, IndexError, TypeError) as e:
+            logger.error("Error decoding batch response from Claude API: %s", e)
+            return None
+        if not isinstance(results, dict):
+            logger.error("Unexpected batch response from Claude API: %s", response_json['content'][0]['text'])
+            return None
+        logger.info("Received batch tags from Claude API.")
+        # Drop malformed entries so those documents fall back to single requests
+        return {doc_id: tags for doc_id, tags in results.items()
+                if isinstance(tags, list) and all(isinstance(tag, str) for tag in tags)}
+    else:
+        logger.error("Error with Claude API: %s, %s", response.status, response_body)
+        return None
+
+class ClaudeBatcher:
+    """
+    Collect concurrent Claude tag requests and send them as multi-document batches.
+    A batch is sent once it holds `batch_size` files, would exceed `max_chars`, or has waited `max_wait` seconds.
+    """
+
+    def __init__(self, batch_size, max_chars, max_wait=0.5):
+        self.batch_size = batch_size
+        self.max_chars = max_chars
+        self.max_wait = max_wait
+        self.pending = []
+        self.pending_chars = 0
+        self.timer = None
+        self.tasks = set()
+
+    async def submit(self, session, stats, file_path, content):
+        """
+        Queue the content of `file_path` for the next batch and wait for its tags.
+        """
+        loop = asyncio.get_running_loop()
+        if self.pending and self.pending_chars + len(content) > self.max_chars:
+            self.flush(session, stats)
+        future = loop.create_future()
+        self.pending.append((file_path, content, future))
+        self.pending_chars += len(content)
+        if len(self.pending) >= self.batch_size:
+            self.flush(session, stats)
+        elif self.timer is None:
+            self.timer = loop.call_later(self.max_wait, self.flush, session, stats)
+        return await future
+
+    def flush(self, session, stats):
+        """
+        Send whatever is pending as one batch.
+        """
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        batch, self.pending, self.pending_chars = self.pending, [], 0
+        if batch:
+            task = asyncio.ensure_future(self.send(session, stats, batch))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def send(self, session, stats, batch):
+        items = [(str(i + 1), content) for i, (_, content, _) in enumerate(batch)]
+        try:
+            async with sem:
+                results = await get_suggested_tags_claude_batch(session, stats, items) or {}
+            # Fall back to single requests for any document missing from the batch response
+            missing = [(doc_id, file_path, content) for (doc_id, content), (file_path, _, _) in zip(items, batch)
+                       if doc_id not in results]
+            if missing:
+                async def single(file_path, content):
+                    async with sem:
+                        return await get_suggested_tags_claude(session, stats, file_path, content)
+                fallback = await asyncio.gather(*(single(file_path, content) for _, file_path, content in missing))
+                results.update(zip((doc_id for doc_id, _, _ in missing), fallback))
+        except Exception as e:
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (doc_id, _), (_, _, future) in zip(items, batch):
+            future.set_result(results[doc_id])
+
+claude_batcher = ClaudeBatcher(batch_size, batch_max_chars)
+
 def extract_existing_tags(content):
     """
     Extract existing tags from the content.
     """
-    match = re.search(r'\nTags:\s*(.*?)$', content, re.MULTILINE)
+    match = find_tags_line(content)
     if match:
-        return [tag.strip() for tag in match.group(1).split('#') if tag.strip()]
+        return TAG_TOKEN_RE.findall(match.group(1))
     return []
 
-def print_statistics(processed_files):
+def find_tags_line(content):
+    """
+    Find the last Tags line in the content, returning its match or None.
+    """
+    # Most notes have no Tags line, and when present it is usually at the end
+    tags_start = content.rfind('\nTags:')
+    if tags_start == -1:
+        return None
+    return TAGS_RE.search(content, tags_start)
+
+def print_statistics(stats):
     """
     Print comprehensive statistics about the processed files and script performance.
     """
-    total_files = len(processed_files)
-    tags_updated = sum(1 for file in processed_files if file['status'] == 'tags_updated')
-    existing_tags = sum(1 for file in processed_files if file['status'] == 'existing_tags')
-    failed = sum(1 for file in processed_files if file['status'] == 'failed')
+    total_files = sum(stats.file_counts.values())
+    tags_updated = stats.file_counts['tags_updated']
+    existing_tags = stats.file_counts['existing_tags']
+    failed = stats.file_counts['failed']
     
     end_time = time.time()
-    run_time = end_time - start_time
+    run_time = end_time - stats.start_time
     
-    print(f"\n{Fore.CYAN}=== Run Statistics ==={Style.RESET_ALL}")
-    print(f"{Fore.WHITE}Total files processed: {total_files}{Style.RESET_ALL}")
-    print(f"{Fore.GREEN}Files with tags updated: {tags_updated}{Style.RESET_ALL}")
-    print(f"{Fore.BLUE}Files with existing tags: {existing_tags}{Style.RESET_ALL}")
-    print(f"{Fore.RED}Files that failed: {failed}{Style.RESET_ALL}")
+    logger.info("=== Run Statistics ===")
+    logger.info("Total files processed: %d", total_files)
+    logger.info("Files with tags updated: %d", tags_updated)
+    logger.info("Files with existing tags: %d", existing_tags)
+    logger.info("Files that failed: %d", failed)
     
-    print(f"\n{Fore.CYAN}Performance Statistics:{Style.RESET_ALL}")
-    print(f"Total run time: {run_time:.2f} seconds")
-    print(f"Average time per file: {run_time/total_files:.2f} seconds")
-    print(f"Total API queries: {api_queries}")
-    print(f"Total tokens used: {total_tokens}")
+    logger.info("Performance Statistics:")
+    logger.info("Total run time: %.2f seconds", run_time)
+    average_time = run_time / total_files if total_files else 0.0
+    logger.info("Average time per file: %.2f seconds", average_time)
+    logger.info("Total API queries: %d", stats.api_queries)
+    logger.info("Total tokens used: %d", stats.total_tokens)
     
     if not use_ollama:
         # Estimate cost (assuming $0.08 per 1K tokens for Claude 3)
-        estimated_cost = (total_tokens / 1000) * 0.08
-        print(f"\n{Fore.YELLOW}Estimated API cost: ${estimated_cost:.2f}{Style.RESET_ALL}")
+        estimated_cost = (stats.total_tokens / 1000) * 0.08
+        logger.info("Estimated API cost: $%.2f", estimated_cost)
     else:
-        print(f"\n{Fore.YELLOW}Using Ollama locally (no API costs){Style.RESET_ALL}")
+        logger.info("Using Ollama locally (no API costs)")
 
-def main():
+async def main():
+    global sem
     if not obsidian_directory:
-        print(f"{Fore.RED}Error: OBSIDIAN_DIRECTORY not set in .env file.{Style.RESET_ALL}")
+        logger.error("Error: OBSIDIAN_DIRECTORY not set in .env file.")
     elif not use_ollama and not claude_api_key:
-        print(f"{Fore.RED}Error: CLAUDE_API_KEY not set in .env file and Ollama is not enabled.{Style.RESET_ALL}")
+        logger.error("Error: CLAUDE_API_KEY not set in .env file and Ollama is not enabled.")
     else:
-        print(f"{Fore.GREEN}Starting Obsidian Tag Generator{Style.RESET_ALL}")
-        print(f"{Fore.CYAN}Using {'Ollama' if use_ollama else 'Claude API'} for tag generation{Style.RESET_ALL}")
-        scan_directory(obsidian_directory)
-        print(f"\n{Fore.GREEN}Obsidian Tag Generator completed.{Style.RESET_ALL}")
+        logger.info("Starting Obsidian Tag Generator")
+        logger.info("Using %s for tag generation", 'Ollama' if use_ollama else 'Claude API')
+        sem = asyncio.Semaphore(concurrency)
+        open_tag_cache()
+        load_file_index()
+        try:
+            # One pooled session so TCP/TLS connections are reused across requests
+            async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=120),
+                                             connector=aiohttp.TCPConnector(limit=32)) as session:
+                await scan_directory(session, Stats(), obsidian_directory)
+        finally:
+            tag_cache.close()
+            save_file_index()
+        logger.info("Obsidian Tag Generator completed.")
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())